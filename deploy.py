@@ -2,180 +2,383 @@ import sys
 import subprocess
 import platform
 import glob
-import re
+import hashlib
+import http.client
+import json
 import os
+import shutil
+import tempfile
+import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 
 # Disable output buffering to ensure real-time log output
 sys.stdout.reconfigure(line_buffering=True)
 sys.stderr.reconfigure(line_buffering=True)
 
+# Lowercased file names whose change requires rebuilding the app image, as bytes to match raw git output
+_BUILD_FILENAMES_B = frozenset({b"requirements", b"requirements.txt", b"compose.yaml", b"compose.yml"})
+
+# Platform of this host, as named in the sops release assets
+_SYS = platform.system().lower()
+_MACHINE = os.uname().machine
+_ARCH = "amd64" if _MACHINE == "x86_64" else _MACHINE
+
+
+def get_file_checksum(path: Union[str, bytes, Path]) -> str:
+    """Returns the sha256 hex digest of a file."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+, reads and hashes in C
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
 
 class Deploy:
+    # upper bound on apps deployed concurrently, keeps the docker daemon from thrashing
+    MAX_PARALLEL = 4
+
     def __init__(self, fleet_dir: str, docker_bin: str) -> None:
         self.fleet_dir = fleet_dir
+        self._base_cwd = os.fspath(fleet_dir)
         self.docker_bin = docker_bin
         self.deploy_dir = os.path.dirname(os.path.abspath(__file__))
+        self.manifest_path = os.path.join(self.deploy_dir, ".deploy_manifest.json")
         self.sops_path = self.download_sops("v3.11.0")
+        self._log_lock = threading.Lock()
+
+    def log(self, msg: str, file=sys.stdout) -> None:
+        """Prints a line without interleaving output from concurrent apps."""
+        with self._log_lock:
+            print(msg, file=file)
 
     def run_cmd(self, cmd: List[str], cwd: Optional[Union[str, Path]] = None, capture: bool = False) -> Optional[str]:
         """Runs a shell command."""
-        cwd_path = Path(cwd) if cwd else Path(self.fleet_dir)
+        # Keep spawns free of preexec_fn, start_new_session and uid/gid changes: on Linux this lets
+        # CPython use vfork() instead of fork(), so no page tables are copied for every git/docker call.
+        cwd_str = os.fspath(cwd) if cwd is not None else self._base_cwd
         if capture:
-            return subprocess.check_output(cmd, cwd=cwd_path, text=True).strip()
+            return subprocess.check_output(cmd, cwd=cwd_str, text=True).strip()
         else:
-            subprocess.run(cmd, cwd=cwd_path, check=True)
+            subprocess.run(cmd, cwd=cwd_str, check=True)
             return None
 
+    def run_cmd_lines(
+        self, cmd: List[str], cwd: Optional[Union[str, Path]] = None, sep: bytes = b"\n"
+    ) -> Iterator[bytes]:
+        """Runs a command and yields its non-empty output records, split on sep, as undecoded bytes."""
+        cwd_str = os.fspath(cwd) if cwd is not None else self._base_cwd
+        with subprocess.Popen(cmd, cwd=cwd_str, stdout=subprocess.PIPE) as proc:
+            pending = b""
+            for chunk in iter(lambda: proc.stdout.read1(1 << 16), b""):
+                *records, pending = (pending + chunk).split(sep)
+                for record in records:
+                    if record:
+                        yield record
+            if pending:
+                yield pending
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
     def download_sops(self, sops_version):
-        system = platform.system().lower()
-        arch = os.uname().machine
-        if arch == "x86_64":
-            arch = "amd64"
+        sops_filename = f"sops-{sops_version}.{_SYS}.{_ARCH}"
+        sops_path = os.path.join(self.deploy_dir, sops_filename)
+        if os.path.isfile(sops_path):
+            return sops_path
 
         base_url = "https://github.com/getsops/sops/releases/download"
-        sops_filename = f"sops-{sops_version}.{system}.{arch}"
-        sops_path = os.path.join(self.deploy_dir, sops_filename)
         sops_url = f"{base_url}/{sops_version}/{sops_filename}"
 
-        if not os.path.isfile(sops_path):
-            old_sops_files = glob.glob(f"sops-*.{system}.{arch}")
-            for old_file in old_sops_files:
+        # download to a temporary file so an interrupted download never leaves a partial binary behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.deploy_dir, prefix=f".{sops_filename}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp, urllib.request.urlopen(sops_url, timeout=60) as response:
+                shutil.copyfileobj(response, tmp, length=1 << 20)
+            os.chmod(tmp_path, 0o755)
+            os.replace(tmp_path, sops_path)
+        except (OSError, http.client.HTTPException) as e:
+            print(f"Error: Failed to download {sops_filename}: {e}")
+            exit(1)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Downloaded {sops_filename} successfully")
+
+        old_sops_files = glob.glob(os.path.join(self.deploy_dir, f"sops-*.{_SYS}.{_ARCH}"))
+        for old_file in old_sops_files:
+            if old_file != sops_path:
                 os.remove(old_file)
                 print(f"Removed old version: {old_file}")
 
-            result = self.run_cmd(["curl", "-LO", sops_url], cwd=self.deploy_dir)
-            if result != 0:
-                print(f"Error: Failed to download {sops_filename}")
-                exit(1)
-
-            os.chmod(sops_path, 0o755)
-            print(f"Downloaded {sops_filename} successfully")
-
         return sops_path
 
     def find_app_dirs(self) -> List[Path]:
         """Finds all directories containing a compose.yaml file."""
-        base = Path(self.fleet_dir)
-        return [d for d in base.iterdir() if d.is_dir() and (d / "compose.yaml").exists()]
+        # DirEntry.is_dir() uses the type reported by the directory listing, saving a stat per entry
+        with os.scandir(self.fleet_dir) as entries:
+            return [
+                Path(e.path)
+                for e in entries
+                if e.is_dir(follow_symlinks=False) and os.path.isfile(os.path.join(e.path, "compose.yaml"))
+            ]
 
-    def git_changed_files_for_dir(self, app_dir: Path) -> List[str]:
-        """Returns a list of changed files for a specific app directory between commits."""
-        try:
-            out = self.run_cmd(
-                ["git", "diff", "--name-only", self.prev_commit, self.current_commit, "--", str(app_dir)], capture=True
-            )
-            if out:
-                return [line for line in out.splitlines() if line.strip()]
-            return []
-        except subprocess.CalledProcessError:
-            return []
+    def scan_changes(self, base_commit: str, app_dirs: List[Path]) -> Dict[str, bool]:
+        """Streams the diff from base_commit to the current commit once, returning needs_build per changed app."""
+        # paths stay bytes, only the app names that changed are decoded
+        app_names = {os.fsencode(d.name): d.name for d in app_dirs}
+        changed, rebuild = set(), set()
+        # --no-renames: a file moved between apps must count as a change in both
+        # -z: NUL-separated paths are never C-quoted, so non-ASCII names stay raw bytes
+        diff_cmd = ["git", "diff", "--name-only", "--no-renames", "-z", base_commit, self.current_commit]
+        for line in self.run_cmd_lines(diff_cmd, sep=b"\0"):
+            dirname, sep, _ = line.partition(b"/")
+            if not sep or dirname not in app_names:
+                continue
+            changed.add(dirname)
+            if dirname not in rebuild and self.needs_build(line):
+                rebuild.add(dirname)
+        return {app_names[name]: name in rebuild for name in changed}
 
-    def needs_build(self, changed_files: List[str]) -> bool:
-        """Determines if a rebuild is needed based on changed files."""
-        pattern = re.compile(r"(^|/)(Dockerfile|requirements(\.txt)?$|compose\.ya?ml$|compose\.yml$)", re.IGNORECASE)
+    def collect_changes(self) -> Dict[str, bool]:
+        """Returns needs_build per app that has changes to reconcile, one diff per distinct base commit."""
+        # every app takes the new commits; an app whose last deploy failed also takes what it missed since
+        bases: Dict[str, List[Path]] = {}
+        if self.current_commit != self.prev_commit:
+            bases[self.prev_commit] = list(self.app_dirs)
+        for app_dir in self.app_dirs:
+            deployed_commit = self.manifest.get(app_dir.name, {}).get("commit")
+            if deployed_commit not in (None, self.prev_commit, self.current_commit):
+                bases.setdefault(deployed_commit, []).append(app_dir)
 
-        for f in changed_files:
-            if pattern.search(f):
-                return True
-        return False
+        changes: Dict[str, bool] = {}
+        for base_commit, app_dirs in bases.items():
+            try:
+                base_changes = self.scan_changes(base_commit, app_dirs)
+            except subprocess.CalledProcessError:
+                if base_commit == self.prev_commit:
+                    continue
+                # the recorded commit is gone (e.g. rewritten history), so reconcile these apps in full
+                base_changes = {d.name: True for d in app_dirs}
+            for name, rebuild in base_changes.items():
+                changes[name] = changes.get(name, False) or rebuild
+        return changes
+
+    def needs_build(self, changed_file: bytes) -> bool:
+        """Determines if a changed file (a raw git path) requires a rebuild."""
+        name = changed_file.rsplit(b"/", 1)[-1].lower()
+        # Dockerfile also covers variants such as Dockerfile.dev
+        return name in _BUILD_FILENAMES_B or name.startswith(b"dockerfile")
+
+    def start_cleanup(self) -> None:
+        """Starts pruning unused docker images in the background."""
+        print(">> Pruning system...")
+        self._prune_proc = subprocess.Popen(
+            [self.docker_bin, "system", "prune", "-af"],
+            cwd=self._base_cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
 
     def global_cleanup(self) -> None:
-        """Prunes unused docker images."""
+        """Waits for the background prune started by start_cleanup."""
+        out, err = self._prune_proc.communicate()
+        if out:
+            print(out.rstrip())
+        if self._prune_proc.returncode:
+            print(f"WARNING: docker system prune failed: {err.strip()}", file=sys.stderr)
+
+    def build_fingerprint(self, app_dir: Path) -> Optional[str]:
+        """Returns a sha256 over the paths and contents of the app's tracked build-relevant files."""
+        sha256 = hashlib.sha256()
         try:
-            print(">> Pruning system...")
-            self.run_cmd([self.docker_bin, "system", "prune", "-af"])
-        except subprocess.CalledProcessError as e:
-            print(f"WARNING: docker system prune failed: {e}", file=sys.stderr)
+            for path in self.run_cmd_lines(["git", "ls-files", "-z", "--", app_dir.name], sep=b"\0"):
+                if self.needs_build(path):
+                    checksum = get_file_checksum(os.path.join(os.fsencode(self._base_cwd), path))
+                    sha256.update(path + b"\0" + checksum.encode() + b"\n")
+        except (subprocess.CalledProcessError, OSError):
+            # without a fingerprint the app simply gets a normal rebuild
+            return None
+        return sha256.hexdigest()
 
-    def manipulate_app(self, app_dir: Path, rebuild: bool) -> None:
+    def running_compose_dirs(self) -> Set[str]:
+        """Returns the resolved working directories of compose projects with running containers, in one docker call."""
+        try:
+            out = self.run_cmd(
+                [
+                    self.docker_bin,
+                    "ps",
+                    "--filter",
+                    "label=com.docker.compose.project",
+                    "--format",
+                    '{{.Label "com.docker.compose.project.working_dir"}}',
+                ],
+                capture=True,
+            )
+        except subprocess.CalledProcessError:
+            return set()
+        # keyed by directory, so it does not matter whether the project is named by name: or COMPOSE_PROJECT_NAME
+        return {os.path.realpath(d) for d in out.splitlines() if d}
+
+    def manipulate_app(self, app_dir: Path, rebuild: bool, is_running: bool) -> None:
         """Restarts or rebuilds the valid app in the given directory."""
         if rebuild:
-            print(f"   [Build-relevant changes] Rebuilding and deploying {app_dir}...")
+            self.log(f"   [Build-relevant changes] Rebuilding and deploying {app_dir}...")
             self.run_cmd([self.docker_bin, "compose", "up", "-d", "--build", "--remove-orphans"], cwd=app_dir)
         else:
-            print(f"   [Runtime-only changes] Checking {app_dir}...")
-            try:
-                # Check if containers are running
-                project_containers = self.run_cmd([self.docker_bin, "compose", "ps", "-q"], cwd=app_dir, capture=True)
-            except subprocess.CalledProcessError:
-                project_containers = ""
-
-            if project_containers:
-                print("   Restarting...")
+            self.log(f"   [Runtime-only changes] Checking {app_dir}...")
+            if is_running:
+                self.log(f"   Restarting {app_dir}...")
                 self.run_cmd([self.docker_bin, "compose", "restart"], cwd=app_dir)
             else:
-                print("   Creating (up)...")
+                self.log(f"   Creating (up) {app_dir}...")
                 self.run_cmd([self.docker_bin, "compose", "up", "-d", "--remove-orphans"], cwd=app_dir)
 
     def updating_repo(self) -> None:
         """Updates the git repository."""
         print(">> Updating repository...")
         self.prev_commit = self.run_cmd(["git", "rev-parse", "HEAD"], capture=True)
+        # ask the remote for its tip first, an idle repo then needs no fetch at all
+        remote_commit = self.run_cmd(["git", "ls-remote", "origin", "refs/heads/main"], capture=True).split("\t")[0]
+        if remote_commit == self.prev_commit:
+            print(">> Repository is up to date.")
+            self.current_commit = self.prev_commit
+            return
+
+        # the fetched history contains the advertised tip, so reset straight to it
         self.run_cmd(["git", "fetch", "origin", "main"])
-        self.run_cmd(["git", "reset", "--hard", "origin/main"])
-        self.current_commit = self.run_cmd(["git", "rev-parse", "HEAD"], capture=True)
+        self.current_commit = remote_commit
+        self.run_cmd(["git", "reset", "--hard", self.current_commit])
 
         # update submodules if .gitmodules exists
         if (Path(self.fleet_dir) / ".gitmodules").exists():
             print(">> Updating submodules...")
             self.run_cmd(["git", "submodule", "update", "--init"])
 
-    def decrypt_secrets(self, app_dir: Path, changed_files: List[str]) -> None:
-        """Decrypts .env.enc using ssh private key if it's added or changed."""
+    def decrypt_secrets(self, app_dir: Path) -> None:
+        """Decrypts .env.enc using ssh private key unless .env was already decrypted from this exact ciphertext."""
         env_enc_path = os.path.join(app_dir, ".env.enc")
         env_path = os.path.join(app_dir, ".env")
+        hash_path = os.path.join(app_dir, ".env.sops-hash")
         if not os.path.isfile(env_enc_path):
-            if os.path.exists(env_path):
-                os.remove(env_path)
+            for path in (env_path, hash_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        # compare content rather than the diff, so a failed or interrupted decrypt is retried on the next run
+        checksum = get_file_checksum(env_enc_path)
+        try:
+            with open(hash_path) as f:
+                decrypted_checksum = f.read().strip()
+        except OSError:
+            decrypted_checksum = None
+        if decrypted_checksum == checksum and os.path.exists(env_path):
+            self.log(f"   [Secrets unchanged] {env_path} is up to date")
             return
 
-        for f in changed_files:
-            if f.endswith(".env.enc"):
-                print(f"   [Secrets change] Decrypting {env_enc_path} to {env_path}...")
-                # use sops to decrypt self.sops_filename
-                self.run_cmd(
-                    [
-                        f"./{self.sops_filename}",
-                        "--input-type",
-                        "dotenv",
-                        "--output-type",
-                        "dotenv",
-                        "--output",
-                        str(env_path),
-                        "--decrypt",
-                        str(env_enc_path),
-                    ],
-                    cwd=deploy_dir,
-                )
-                break
+        self.log(f"   [Secrets change] Decrypting {env_enc_path} to {env_path}...")
+        # runs inside the per-app worker, so decrypts of different apps overlap their KMS round-trips
+        self.run_cmd(
+            [
+                self.sops_path,
+                "--input-type",
+                "dotenv",
+                "--output-type",
+                "dotenv",
+                "--output",
+                str(env_path),
+                "--decrypt",
+                str(env_enc_path),
+            ],
+            cwd=self.deploy_dir,
+        )
+        with open(hash_path, "w") as f:
+            f.write(checksum)
+
+    def _load_manifest(self) -> Dict[str, Dict[str, str]]:
+        """Loads the last successfully deployed commit and build fingerprint per app directory name."""
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self) -> None:
+        """Atomically writes the manifest next to this script."""
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _process(self, app_dir: Path) -> Tuple[Path, Optional[str], Optional[Exception]]:
+        """Deploys a single app, returning its new build fingerprint and any error instead of raising it."""
+        self.log(f">> Processing app: {app_dir}")
+
+        rebuild = self.changes.get(app_dir.name)
+        if rebuild is None:
+            self.log(f"   [No changes] Skipping {app_dir}")
+            return app_dir, None, None
+
+        deployed = self.manifest.get(app_dir.name, {})
+        build_hash = None
+        # a failing app must not stop the others from being deployed and recorded
+        try:
+            if rebuild:
+                # a build file showing up in the diff is not enough, its content must differ from the last build
+                build_hash = self.build_fingerprint(app_dir)
+                if build_hash is not None and build_hash == deployed.get("build_hash"):
+                    self.log(f"   [Build inputs unchanged] {app_dir} was already built from this content")
+                    rebuild, build_hash = False, None
+            # decrypt secrets if needed (if added/changed .env.enc SOPS file)
+            self.decrypt_secrets(app_dir)
+            is_running = os.path.realpath(app_dir) in self.running_dirs
+            self.manipulate_app(app_dir, rebuild, is_running)
+        except Exception as e:
+            return app_dir, None, e
+        return app_dir, build_hash, None
 
     def run(self) -> None:
         print("--- Starting Deployment ---")
+        # prune while git talks to the remote, but finish before any compose command touches containers
+        self.start_cleanup()
         self.updating_repo()
+        self.global_cleanup()
         self.app_dirs = self.find_app_dirs()
 
         if not self.app_dirs:
             print(">> No compose files found. Nothing to do.")
 
-        for app_dir in self.app_dirs:
-            print(f">> Processing app: {app_dir}")
-
-            changed = self.git_changed_files_for_dir(app_dir)
-            if not changed:
-                print(f"   [No changes] Skipping {app_dir}")
-                continue
+        # the manifest decides which diffs to take, so apps that failed last time are retried
+        self.manifest = self._load_manifest()
+        self.changes = self.collect_changes()
 
-            rebuild = self.needs_build(changed)
-            # decrypt secrets if needed (if added/changed .env.enc SOPS file)
-            self.decrypt_secrets(app_dir, changed)
-            try:
-                self.manipulate_app(app_dir, rebuild)
-            except subprocess.CalledProcessError as e:
-                print(f"ERROR: Docker operation failed for {app_dir}: {e}", file=sys.stderr)
+        if self.app_dirs and not self.changes:
+            print(">> No app changes. Nothing to deploy.")
+        elif self.app_dirs:
+            self.running_dirs = self.running_compose_dirs()
+            with ThreadPoolExecutor(max_workers=min(self.MAX_PARALLEL, len(self.app_dirs))) as pool:
+                futures = [pool.submit(self._process, app_dir) for app_dir in self.app_dirs]
+                for future in as_completed(futures):
+                    app_dir, build_hash, error = future.result()
+                    if error is not None:
+                        self.log(f"ERROR: Deployment failed for {app_dir}: {error}", file=sys.stderr)
+                        # not reconciled: keep its last good commit, or pin it to the one it was deployed from
+                        deployed = self.manifest.setdefault(app_dir.name, {"commit": self.prev_commit})
+                        # a failed `up --build` may already have tagged a new image, so the old fingerprint
+                        # no longer describes what is tagged and must not downgrade the next rebuild
+                        deployed.pop("build_hash", None)
+                        continue
+                    deployed = self.manifest.setdefault(app_dir.name, {})
+                    deployed["commit"] = self.current_commit
+                    if build_hash is not None:
+                        deployed["build_hash"] = build_hash
+            self._save_manifest()
 
-        self.global_cleanup()
         print("--- Deployment Complete ---")
 
 